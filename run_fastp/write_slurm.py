@@ -2,7 +2,152 @@
 from pathlib import Path
 import traceback
 import argparse
-import textwrap
+import subprocess
+import json
+import time
+import os
+
+CONDA_HOOK_EVAL = 'eval "$(conda shell.bash hook)"'
+
+## Folders changed more recently than this are always rescanned (see get_cache_key)
+CACHE_MIN_AGE_NS = 2_000_000_000
+
+TEMPLATE_START = """\
+#!/usr/bin/env bash
+#SBATCH --job-name=CUT_FASTP
+#SBATCH --mail-user={email}
+#SBATCH --mail-type=BEGIN,END,FAIL
+#SBATCH --output=CUT_FASTP_%u_%A_%a.out
+#SBATCH --array=0-{num_jobs}
+#SBATCH --account={slurm_acct}
+#SBATCH --time={walltime}
+#SBATCH --mem={mem}m
+#SBATCH --partition=standard
+#SBATCH --ntasks-per-node=1
+#SBATCH --nodes=1
+################################################################################
+# Edit the strings under 'declare -a tasks=(' to match your experiments.
+#
+# The #SBATCH --array variable above creates an array [0,1,2,3]. Change it so that the length
+# is how many jobs you need (same as number of strings under $tasks).
+#
+# This script is submitted that many times, but only one line from $tasks is
+# evaluated each time.
+#
+# For more info on #SBATCH variables, see https://arc.umich.edu/greatlakes/slurm-user-guide/
+# and https://slurm.schedmd.com/sbatch.html
+#
+# This requires a conda environment with samtools and pysam (RNA-STAR)
+# 
+# To call this script:
+# sbatch write_slurm.sbatch
+################################################################################
+
+module purge
+{conda_hook}
+conda activate ~/miniconda3/envs/RNA-SEQ
+
+declare -a tasks=(
+"""
+
+## get_conda_hook, get_cache_key, load_cached_names and save_cached_names are
+## kept identical to star_alignment/write_slurm_alignment.py; each script is copied
+## and run on its own, so keep the two copies in sync when editing them
+def get_conda_hook() -> str:
+    '''
+    PURPOSE:
+    * Runs `conda shell.bash hook` once, so its output can be inlined into the
+      SBATCH script instead of being re-evaluated by every array task.
+    * Falls back to the usual eval line if conda can't be run from here.
+    '''
+    try:
+        hook = subprocess.run([os.environ.get("CONDA_EXE", "conda"), "shell.bash", "hook"],
+                              capture_output = True, text = True, check = True)
+    except (OSError, subprocess.CalledProcessError):
+        return CONDA_HOOK_EVAL
+    return hook.stdout.strip()
+
+def get_cache_key(folder: str):
+    '''
+    PURPOSE:
+    * Returns a key for the current contents of folder, built from its
+      mtime/size/inode (the mtime changes whenever entries are added/removed).
+    * Returns None (i.e. don't use the cache) if folder changed within the last
+      CACHE_MIN_AGE_NS. On filesystems with 1-second timestamps (common NFS
+      setups), a file added in the same second as the last scan would leave
+      the key unchanged, and the stale names would be reused.
+    '''
+    stat = os.stat(folder)
+    if time.time_ns() - stat.st_mtime_ns < CACHE_MIN_AGE_NS:
+        return None
+    return f"{stat.st_mtime_ns}:{stat.st_size}:{stat.st_ino}"
+
+def load_cached_names(cache: Path, key: str):
+    '''
+    PURPOSE:
+    * Returns the sample names saved in cache if they were saved under key.
+    * Returns None if there is no usable cache (missing, unreadable or
+      malformed), or if the input folder has changed since (key doesn't match).
+    '''
+    if key is None:
+        return None
+    try:
+        with open(cache) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(saved, dict) or saved.get("key") != key:
+        return None
+    names = saved.get("names")
+    if not isinstance(names, list):
+        return None
+    return names
+
+def save_cached_names(cache: Path, key: str, names: list):
+    '''
+    PURPOSE:
+    * Saves names under key, via a temporary file so a half-written cache
+      is never read back.
+    '''
+    if key is None:
+        return
+    tmp = cache.with_suffix(cache.suffix + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump({"key": key, "names": names}, f)
+    os.replace(tmp, cache)
+
+def build_header(num_jobs: int, email: str, slurm_acct: str,
+                 walltime: str, mem: int) -> str:
+    '''
+    PURPOSE:
+    * Fills in TEMPLATE_START, giving everything in the SBATCH script
+      up to (and including) the opening of the task array.
+    '''
+    return TEMPLATE_START.format(email = email, num_jobs = num_jobs,
+                                 slurm_acct = slurm_acct, walltime = walltime,
+                                 mem = mem, conda_hook = get_conda_hook())
+
+def find_samples(start_dir: str, output: Path) -> list:
+    '''
+    PURPOSE:
+    * Returns the unique sample names (everything before the first "_")
+      of all FASTQs in start_dir. Symlinked FASTQs count too.
+    * Reuses the last scan (saved next to output) if start_dir hasn't changed
+      since (see get_cache_key for when it is always rescanned).
+    '''
+    cache_key = get_cache_key(start_dir)
+    cache = output.with_suffix(".sample_cache.json")
+
+    sample_names = load_cached_names(cache, cache_key)
+    if sample_names is None:
+        with os.scandir(start_dir) as it:
+            ## dict.fromkeys drops duplicate names (e.g. R1/R2) but, unlike a set,
+            ## keeps listing order, so reruns write the same task order
+            sample_names = list(dict.fromkeys(entry.name.partition("_")[0] for entry in it
+                                              if entry.name.endswith(".fastq.gz")
+                                              and entry.is_file()))
+        save_cached_names(cache, cache_key, sample_names)
+    return sample_names
 
 def main(input_folder: str, output_folder: str, email: str, 
          slurm_acct: str, walltime: str, mem: int):
@@ -21,11 +166,11 @@ def main(input_folder: str, output_folder: str, email: str,
        "python3 run_cutadapt_fastp.py --input raw_fastqs --output trimmed_reads \ 
         -C 2 -U 12 -S KEH-Rep1-7KO-HEK293T-Cyto-BS_S6"
     '''
-    current_path = Path.cwd()
-    output = current_path/"SBATCHSubArr-CUT_FASTP.sbatch"
+    output = Path("SBATCHSubArr-CUT_FASTP.sbatch")
     
-    start_dir = Path(current_path/input_folder)
-    if not start_dir.exists():
+    ## Relative paths already resolve against the current working directory
+    start_dir = input_folder
+    if not os.path.exists(start_dir):
         raise FileNotFoundError(
             "Please input a folder name that exists "
             "in your current working directory."
@@ -35,66 +180,30 @@ def main(input_folder: str, output_folder: str, email: str,
     1. Obtain all possible sample names
     2. Find total count, and subtract 1 so it's 0-based
     '''
-    sample_names = set([fastq.stem.split("_")[0] 
-                        for fastq in start_dir.glob("*.fastq.gz")])
+    sample_names = find_samples(start_dir, output)
     num_jobs = len(sample_names) - 1
-    
-    ## Create SBATCH file if it doesn't exist
-    if not output.exists():
-        with open(output, "w") as f:
-            template_start = textwrap.dedent(f"""\
-                                            #!/usr/bin/env bash
-                                            #SBATCH --job-name=CUT_FASTP
-                                            #SBATCH --mail-user={email}
-                                            #SBATCH --mail-type=BEGIN,END,FAIL
-                                            #SBATCH --output=CUT_FASTP_%u_%A_%a.out
-                                            #SBATCH --array=0-{num_jobs}
-                                            #SBATCH --account={slurm_acct}
-                                            #SBATCH --time={walltime}
-                                            #SBATCH --mem={mem}m
-                                            #SBATCH --partition=standard
-                                            #SBATCH --ntasks-per-node=1
-                                            #SBATCH --nodes=1
-                                            ################################################################################
-                                            # Edit the strings under 'declare -a tasks=(' to match your experiments.
-                                            #
-                                            # The #SBATCH --array variable above creates an array [0,1,2,3]. Change it so that the length
-                                            # is how many jobs you need (same as number of strings under $tasks).
-                                            #
-                                            # This script is submitted that many times, but only one line from $tasks is
-                                            # evaluated each time.
-                                            #
-                                            # For more info on #SBATCH variables, see https://arc.umich.edu/greatlakes/slurm-user-guide/
-                                            # and https://slurm.schedmd.com/sbatch.html
-                                            #
-                                            # This requires a conda environment with samtools and pysam (RNA-STAR)
-                                            # 
-                                            # To call this script:
-                                            # sbatch write_slurm.sbatch
-                                            ################################################################################
-
-                                            module purge
-                                            eval "$(conda shell.bash hook)"
-                                            conda activate ~/miniconda3/envs/RNA-SEQ
-
-                                            declare -a tasks=(
-                                            """)
-
-            f.write(template_start)
 
+    template_start = build_header(num_jobs, email, slurm_acct, walltime, mem)
+
+    tmp = output.with_suffix(output.suffix + ".tmp")
     try:
-        for name in sample_names:
-            ## Append new tasks to SBATCH
-            with open(output, "a") as f:
-                task = f'\n"python3 run_cutadapt_fastp.py --input {input_folder} --output {output_folder} -C 2 -U 12 -S {name}"'
-                f.write(task)
-
-        ## Once all tasks have been added, finish up SBATCH template
-        with open(output, "a") as f:
-            f.write("\n)\neval ${tasks[$SLURM_ARRAY_TASK_ID]}")
+        ## Only the sample name differs between tasks
+        prefix = f'\n"python3 run_cutadapt_fastp.py --input {input_folder} --output {output_folder} -C 2 -U 12 -S '
+        suffix = '"'
+        tasks = [prefix + name + suffix for name in sample_names]
+
+        content = template_start + "".join(tasks) + "\n)\neval ${tasks[$SLURM_ARRAY_TASK_ID]}"
+
+        ## Write to a temporary file, then swap it in so the SBATCH script
+        ## is never seen half-written (e.g. if this job is killed)
+        ## Encode once and hand the whole script to a single write
+        with open(tmp, "wb") as f:
+            f.write(content.encode("utf-8"))
+        os.replace(tmp, output)
     except Exception as e:
         print("Failed to create SBATCH file: {e}")
         traceback.print_exc()
+        tmp.unlink(missing_ok = True)
         raise
 
 if __name__ == "__main__":
@@ -2,102 +2,240 @@
 from pathlib import Path
 import traceback
 import argparse
-import textwrap
+import subprocess
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 import os
 
+CONDA_HOOK_EVAL = 'eval "$(conda shell.bash hook)"'
+
+## Folders changed more recently than this are always rescanned (see get_cache_key)
+CACHE_MIN_AGE_NS = 2_000_000_000
+
+TEMPLATE_START = """\
+#!/usr/bin/env bash
+#SBATCH --job-name=ALIGN
+#SBATCH --mail-user={email}
+#SBATCH --mail-type=BEGIN,END,FAIL
+#SBATCH --output=ALIGN_%u_%A_%a.out
+#SBATCH --array=0-{num_jobs}
+#SBATCH --account={slurm_acct}
+#SBATCH --time={walltime}
+#SBATCH --mem={mem}m
+#SBATCH --partition=standard
+#SBATCH --cpus-per-task=8
+################################################################################
+# Edit the strings under 'declare -a tasks=(' to match your experiments.
+#
+# Recommend 1.5 hours per 30M read sample, 2.5 for 2-pass STAR.
+#
+# This requires a conda environment for genome alignment, edit to your named
+# version in the activate command.
+# 
+# To call this script:
+# sbatch SBATCHSubArr-Align-STAR.sbatch
+################################################################################
+
+module purge
+{conda_hook}
+conda activate ~/miniconda3/envs/RNA-SEQ
+
+declare -a tasks=(
+"""
+
+## get_conda_hook, get_cache_key, load_cached_names and save_cached_names are
+## kept identical to run_fastp/write_slurm.py; each script is copied
+## and run on its own, so keep the two copies in sync when editing them
+def get_conda_hook() -> str:
+    '''
+    PURPOSE:
+    * Runs `conda shell.bash hook` once, so its output can be inlined into the
+      SBATCH script instead of being re-evaluated by every array task.
+    * Falls back to the usual eval line if conda can't be run from here.
+    '''
+    try:
+        hook = subprocess.run([os.environ.get("CONDA_EXE", "conda"), "shell.bash", "hook"],
+                              capture_output = True, text = True, check = True)
+    except (OSError, subprocess.CalledProcessError):
+        return CONDA_HOOK_EVAL
+    return hook.stdout.strip()
+
+def get_cache_key(folder: str):
+    '''
+    PURPOSE:
+    * Returns a key for the current contents of folder, built from its
+      mtime/size/inode (the mtime changes whenever entries are added/removed).
+    * Returns None (i.e. don't use the cache) if folder changed within the last
+      CACHE_MIN_AGE_NS. On filesystems with 1-second timestamps (common NFS
+      setups), a file added in the same second as the last scan would leave
+      the key unchanged, and the stale names would be reused.
+    '''
+    stat = os.stat(folder)
+    if time.time_ns() - stat.st_mtime_ns < CACHE_MIN_AGE_NS:
+        return None
+    return f"{stat.st_mtime_ns}:{stat.st_size}:{stat.st_ino}"
+
+def load_cached_names(cache: Path, key: str):
+    '''
+    PURPOSE:
+    * Returns the sample names saved in cache if they were saved under key.
+    * Returns None if there is no usable cache (missing, unreadable or
+      malformed), or if the input folder has changed since (key doesn't match).
+    '''
+    if key is None:
+        return None
+    try:
+        with open(cache) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(saved, dict) or saved.get("key") != key:
+        return None
+    names = saved.get("names")
+    if not isinstance(names, list):
+        return None
+    return names
+
+def save_cached_names(cache: Path, key: str, names: list):
+    '''
+    PURPOSE:
+    * Saves names under key, via a temporary file so a half-written cache
+      is never read back.
+    '''
+    if key is None:
+        return
+    tmp = cache.with_suffix(cache.suffix + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump({"key": key, "names": names}, f)
+    os.replace(tmp, cache)
+
+def build_header(num_jobs: int, email: str, slurm_acct: str,
+                 walltime: str, mem: int) -> str:
+    '''
+    PURPOSE:
+    * Fills in TEMPLATE_START, giving everything in the SBATCH script
+      up to (and including) the opening of the task array.
+    '''
+    return TEMPLATE_START.format(email = email, num_jobs = num_jobs,
+                                 slurm_acct = slurm_acct, walltime = walltime,
+                                 mem = mem, conda_hook = get_conda_hook())
+
+def list_subfolders(folder: str) -> list:
+    '''
+    PURPOSE:
+    * Returns the sample names (folder name without its suffix, as with
+      Path.stem) of all subfolders directly inside folder.
+    * Symlinked subfolders count too.
+    '''
+    with os.scandir(folder) as it:
+        return [os.path.splitext(entry.name)[0] for entry in it if entry.is_dir()]
+
+def find_samples(start_dir: str, output: Path) -> list:
+    '''
+    PURPOSE:
+    * "align" mode: every subfolder of start_dir is one sample.
+    * Reuses the last scan (saved next to output) if start_dir hasn't changed
+      since (see get_cache_key for when it is always rescanned).
+    '''
+    cache_key = get_cache_key(start_dir)
+    cache = output.with_suffix(".sample_cache.json")
+
+    sample_names = load_cached_names(cache, cache_key)
+    if sample_names is None:
+        sample_names = list_subfolders(start_dir)
+        save_cached_names(cache, cache_key, sample_names)
+    return [(start_dir, sample_name) for sample_name in sample_names]
+
+def find_nested_samples(start_dir: str) -> list:
+    '''
+    PURPOSE:
+    * "realign" mode: every folder in start_dir holds one subfolder per sample.
+    * Symlinked folders are followed at both levels.
+    * Scans folders in parallel, since each scandir mostly waits on the
+      filesystem (e.g. NFS round trips) with the GIL released.
+    '''
+    with os.scandir(start_dir) as it:
+        folders = [entry.path for entry in it if entry.is_dir()]
+
+    with ThreadPoolExecutor(max_workers = 16) as executor:
+        subfolders = list(executor.map(list_subfolders, folders))
+
+    return [(folder, sample_name)
+            for folder, sample_names in zip(folders, subfolders)
+            for sample_name in sample_names]
+
 def main(input_folder: str, output_folder: str, aligner_type: str,
          genome_idx: str, filter_idx: str, library: str,
          two_pass: bool, emit_dedup: str, email: str, 
-         slurm_acct: str, walltime: str, mem: int):
+         slurm_acct: str, walltime: str, mem: int, mode: str = "align"):
     '''
     PURPOSE:
     * Goes into folder containing all subfolders for trimmed reads,
       then obtains all sample names.
+      -> With mode "realign", goes one level deeper: input_folder contains
+         folders, each holding the subfolders for trimmed reads.
     * Automatically appends new task containing sample name to SBATCH script,
       which then aligns reads using HISAT2 or STAR.
     '''
-    current_path = Path.cwd()
-    output = current_path/"SBATCHSubArr-Align-STAR.sbatch"
+    output = Path("SBATCHSubArr-Align-STAR.sbatch")
     
-    start_dir = Path(current_path/input_folder)
-    if not start_dir.exists():
+    ## Relative paths already resolve against the current working directory
+    start_dir = input_folder
+    if not os.path.exists(start_dir):
         raise FileNotFoundError(
             "Please input a folder name that exists "
             "in your current working directory."
         )
     
     '''
-    1. Count all subfolders in start_dir
-    2. Subtract 1 so count is 0-based
+    1. Collect (folder, sample name) for every sample
+    2. Count them, and subtract 1 so count is 0-based
     '''
-    num_jobs = len(next(os.walk(start_dir))[1]) - 1
-    
-    ## Create SBATCH file if it doesn't exist
-    if not output.exists():
-        with open(output, "w") as f:
-            template_start = textwrap.dedent(f"""\
-                                            #!/usr/bin/env bash
-                                            #SBATCH --job-name=ALIGN
-                                            #SBATCH --mail-user={email}
-                                            #SBATCH --mail-type=BEGIN,END,FAIL
-                                            #SBATCH --output=ALIGN_%u_%A_%a.out
-                                            #SBATCH --array=0-{num_jobs}
-                                            #SBATCH --account={slurm_acct}
-                                            #SBATCH --time={walltime}
-                                            #SBATCH --mem={mem}m
-                                            #SBATCH --partition=standard
-                                            #SBATCH --cpus-per-task=8
-                                            ################################################################################
-                                            # Edit the strings under 'declare -a tasks=(' to match your experiments.
-                                            #
-                                            # Recommend 1.5 hours per 30M read sample, 2.5 for 2-pass STAR.
-                                            #
-                                            # This requires a conda environment for genome alignment, edit to your named
-                                            # version in the activate command.
-                                            # 
-                                            # To call this script:
-                                            # sbatch SBATCHSubArr-Align-STAR.sbatch
-                                            ################################################################################
-
-                                            module purge
-                                            eval "$(conda shell.bash hook)"
-                                            conda activate ~/miniconda3/envs/RNA-SEQ
-
-                                            declare -a tasks=(
-                                            """)
-
-            f.write(template_start)
+    if mode == "realign":
+        samples = find_nested_samples(start_dir)
+    else:
+        samples = find_samples(start_dir, output)
+    num_jobs = len(samples) - 1
+
+    template_start = build_header(num_jobs, email, slurm_acct, walltime, mem)
 
+    tmp = output.with_suffix(output.suffix + ".tmp")
     try:
-        for subfolder in start_dir.iterdir():
-            if subfolder.is_dir():
-                ## Append new tasks to SBATCH
-                sample_name = str(subfolder.stem)
-                with open(output, "a") as f:
-                    task = (f'\n"python3 -u run_align.py --input {input_folder} --output {output_folder} '
-                            f'--aligner {aligner_type} --index {genome_idx} '
-                            f'-C 8 -L {library} -S {sample_name}')
-                    
-                    if (filter_idx):
-                        task += f' --filter_index {filter_idx}'
-
-                    if (two_pass):
-                        task += f' -T --emit_dedup_slurm {emit_dedup}'
-                    
-                    task += '"'
-
-                    f.write(task)
-
-        ## Once all tasks have been added, finish up SBATCH template
-        with open(output, "a") as f:
-            f.write("\n)\neval ${tasks[$SLURM_ARRAY_TASK_ID]}")
+        ## Only the folder and sample name differ between tasks
+        prefix = '\n"python3 -u run_align.py --input '
+        middle = (f' --output {output_folder} '
+                  f'--aligner {aligner_type} --index {genome_idx} '
+                  f'-C 8 -L {library} -S ')
+        suffix = ''
+        if (filter_idx):
+            suffix += f' --filter_index {filter_idx}'
+        if (two_pass):
+            suffix += f' -T --emit_dedup_slurm {emit_dedup}'
+        suffix += '"'
+
+        tasks = [prefix + folder + middle + sample_name + suffix
+                 for folder, sample_name in samples]
+
+        content = template_start + "".join(tasks) + "\n)\neval ${tasks[$SLURM_ARRAY_TASK_ID]}"
+
+        ## Write to a temporary file, then swap it in so the SBATCH script
+        ## is never seen half-written (e.g. if this job is killed)
+        ## Encode once and hand the whole script to a single write
+        with open(tmp, "wb") as f:
+            f.write(content.encode("utf-8"))
+        os.replace(tmp, output)
     except Exception as e:
         print("Failed to create SBATCH file: {e}")
         traceback.print_exc()
+        tmp.unlink(missing_ok = True)
         raise
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = "Writes SBATCH script for STAR alignment.")
+    parser.add_argument("--mode", help = "align: each subfolder of input_folder is a sample; "
+                        "realign: each folder of input_folder holds one subfolder per sample",
+                        choices = ["align", "realign"], default = "align")
     parser.add_argument("--input_folder", help = "Name of folder containing all trimmed reads", 
                         required = True)
     parser.add_argument("--output_folder", help = "Name of output folder for aligned reads (after running run_align)", 
@@ -120,5 +258,5 @@ if __name__ == "__main__":
     main(args.input_folder, args.output_folder, args.aligner_type, args.genome_idx,
          args.filter_idx, args.library, args.two_pass, args.emit_dedup,
          args.email, args.slurm_acct, 
-         args.walltime, args.mem)
+         args.walltime, args.mem, args.mode)
     print("Process finished.")
\ No newline at end of file